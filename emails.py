@@ -1,60 +1,197 @@
 import imapclient
 import email
 from email.header import decode_header
-import spacy
-from datetime import datetime, timedelta
+from email.message import Message
+from email.parser import BytesHeaderParser
 import os
+import logging
 import re
+import time
+from bisect import bisect_right
+from functools import lru_cache
+import ahocorasick
+from imapclient.exceptions import IMAPClientError
 from dotenv import load_dotenv
 from dateutil import parser
 from typing import Dict, List
 
 # Chargement des variables (file .env)
 load_dotenv()
+_IMAP_SERVER = os.getenv("IMAP_SERVER")
+_EMAIL_USER = os.getenv("EMAIL_USER")
+_EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+
+logger = logging.getLogger(__name__)
+
+# Nombre d'emails recuperes par requete FETCH
+FETCH_BATCH_SIZE = 100
+# Nombre de textes par lot pour nlp.pipe
+NLP_BATCH_SIZE = 50
+# En dessous de ce nombre d'emails, le cout du multiprocessing n'est pas rentable
+NLP_MULTIPROCESS_THRESHOLD = 50
+# Composants spaCy inutiles (seuls tok2vec + ner sont utilisés)
+NLP_UNUSED_COMPONENTS = ["morphologizer", "parser", "attribute_ruler", "lemmatizer"]
+
+# Delai d'inactivite (secondes) apres lequel la connexion IMAP est verifiée (NOOP)
+IMAP_KEEPALIVE_DELAY = 5 * 60
+
+# Expressions regulieres precompilees
+_DATE_RE = re.compile(r"\b(\d{2}/\d{2}/\d{4})\b")
+_SHIFT_RE = re.compile(r"(\d{1,2})h(\d{0,2})\s*(?:-|à|au)\s*(\d{1,2})h(\d{0,2})", re.IGNORECASE)
+# Separateur entre les textes d'un lot pour la recherche regex groupée
+_BATCH_SEPARATOR = "\x00---\x00"
+
+URGENCY_KEYWORDS = frozenset({"urgent", "urgence", "immédiat", "asap", "rapidement"})
+
+# Vocabulaires (forme en minuscules -> valeur retenue)
+PROFESSION_VOCAB = {word: word.upper() for word in ["infirmier", "infirmière", "inf", "pab", "auxiliaire"]}
+SHIFT_VOCAB = {f"quart de {moment}": f"quart de {moment}" for moment in ["jour", "soir", "nuit"]}
+LOCATION_BLACKLIST = {word: True for word in ["bonjour", "merci", "service", "rh", "cordialement"]}
+
+
+def _build_automaton(vocab):
+    """Automate Aho-Corasick : recherche de tous les mots-clés en un seul passage"""
+    automaton = ahocorasick.Automaton()
+    for keyword, value in vocab.items():
+        automaton.add_word(keyword, value)
+    automaton.make_automaton()
+    return automaton
+
+
+_URGENCY_AC = _build_automaton({keyword: keyword for keyword in URGENCY_KEYWORDS})
+# Recherche exacte dans un trie, automates construits une seule fois
+_LOCATION_BLACKLIST_AC = _build_automaton(LOCATION_BLACKLIST)
+_SHIFT_AC = _build_automaton(SHIFT_VOCAB)
+
+
+def _batched(seq, n=FETCH_BATCH_SIZE):
+    """Decoupe une sequence en tranches de n elements"""
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+def _nlp_process_count(n_texts):
+    """Nombre de processus pour nlp.pipe selon la taille du lot"""
+    if n_texts < NLP_MULTIPROCESS_THRESHOLD:
+        return 1
+    return max(1, min((os.cpu_count() or 1) - 1, n_texts // NLP_MULTIPROCESS_THRESHOLD))
+
+def _find_dates_batch(texts):
+    """Recherche des dates jj/mm/aaaa de tout un lot en un seul passage regex"""
+    # Position de depart de chaque texte dans la chaine concaténée
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text) + len(_BATCH_SEPARATOR)
+
+    hits = [[] for _ in texts]
+    for match in _DATE_RE.finditer(_BATCH_SEPARATOR.join(texts)):
+        hits[bisect_right(starts, match.start()) - 1].append(match.group(1))
+    return hits
+
+def _decode_subject(subject):
+    """Decodage du sujet (encodage RFC 2047)"""
+    if not subject:
+        return ""
+    if isinstance(subject, bytes):
+        subject = subject.decode(errors="ignore")
+    subject = decode_header(subject)[0][0]
+    if isinstance(subject, bytes):
+        subject = subject.decode(errors="ignore")
+    return subject
+
+def _find_text_plain(structure, section=""):
+    """Localise la premiere partie text/plain d'un BODYSTRUCTURE : (section, encodage, charset)"""
+    if structure.is_multipart:
+        for index, part in enumerate(structure[0], start=1):
+            found = _find_text_plain(part, f"{section}.{index}" if section else str(index))
+            if found:
+                return found
+        return None
+
+    if structure[0].lower() != b"text" or structure[1].lower() != b"plain":
+        return None
+    params = structure[2] or ()
+    params = {key.upper(): value for key, value in zip(params[::2], params[1::2])}
+    charset = params.get(b"CHARSET", b"utf-8").decode(errors="ignore")
+    encoding = (structure[5] or b"7BIT").upper()
+    # Un message non multipart n'a qu'une partie, numérotée "1"
+    return section or "1", encoding, charset
+
+def _decode_part(data, encoding, charset):
+    """Decodage d'une partie MIME selon son Content-Transfer-Encoding"""
+    # Decodeur tolérant du module email (padding base64 invalide, etc.)
+    part = Message()
+    part["Content-Transfer-Encoding"] = encoding.decode()
+    part.set_payload(data.decode("ascii", "surrogateescape"))
+    data = part.get_payload(decode=True)
+    try:
+        return data.decode(charset, errors="ignore")
+    except LookupError:
+        return data.decode(errors="ignore")
+
+@lru_cache(maxsize=1)
+def _get_nlp():
+    """Chargement unique du pipeline spaCy, partagé par tous les agents"""
+    # Import differé : spaCy n'est chargé que si l'analyse NLP est utilisée
+    import spacy
+
+    return spacy.load("fr_core_news_sm", exclude=NLP_UNUSED_COMPONENTS)
 
 class MedicalEmailAgent:
     def __init__(self):
         """Agent intelligent de traitement des emails"""
-        print("### Initialisation de l'agent IA ###")
-        self.nlp = spacy.load("fr_core_news_sm")
+        logger.info("Initialisation de l'agent IA")
         self.conn = None
-        self._setup_nlp_pipeline()
-        self.location_blacklist = {"bonjour", "merci", "service", "rh", "cordialement"}
-
-    def _setup_nlp_pipeline(self):
-        """Configuration du pipeline NLP """
-        ruler = self.nlp.add_pipe("entity_ruler", before="ner")
-        patterns = [
-            {"label": "MEDICAL_PROFESSION", "pattern": [{"LOWER": {"IN": ["infirmier", "infirmière", "inf", "pab", "auxiliaire"]}}]},
-            {"label": "SHIFT_TIME", "pattern": [{"LOWER": "quart"}, {"LOWER": "de"}, {"LOWER": {"IN": ["jour", "soir", "nuit"]}}]},
-            {"label": "URGENCY", "pattern": [{"LEMMA": {"IN": ["urgent", "immédiat", "urgence", "asap"]}}]}
-        ]
-        ruler.add_patterns(patterns)
+        self._last_used = 0.0
+        self._has_processed = False
+
+    @property
+    def nlp(self):
+        """Pipeline spaCy partagé, chargé a la premiere utilisation"""
+        return _get_nlp()
 
     def connect(self):
         """Connexion au serveur IMAP"""
-        print("[INFO] Connexion à Gmail IMAP en cours")
+        logger.info("Connexion à Gmail IMAP en cours")
         try:
-            self.conn = imapclient.IMAPClient(os.getenv("IMAP_SERVER"), ssl=True)
-            self.conn.login(os.getenv("EMAIL_USER"), os.getenv("EMAIL_PASSWORD"))
+            self.conn = imapclient.IMAPClient(_IMAP_SERVER, ssl=True)
+            self.conn.login(_EMAIL_USER, _EMAIL_PASSWORD)
             self.conn.select_folder("INBOX")
-            print("[SUCCESS] Connexion réussie")
+            # Verification unique par connexion de l'existence du dossier "Processed"
+            self._has_processed = "Processed" in {folder[-1] for folder in self.conn.list_folders()}
+            self._last_used = time.monotonic()
+            logger.info("Connexion réussie")
         except Exception as e:
-            print(f"[ERROR] Erreur de connexion: {e}")
+            self.conn = None
+            logger.error("Erreur de connexion: %s", e)
+
+    def _ensure_connection(self):
+        """Reutilise la connexion IMAP existante, reconnexion si necessaire"""
+        if self.conn is not None and time.monotonic() - self._last_used > IMAP_KEEPALIVE_DELAY:
+            try:
+                self.conn.noop()
+            except (IMAPClientError, OSError) as e:
+                logger.warning("Connexion IMAP perdue, reconnexion: %s", e)
+                self.conn = None
+
+        if self.conn is None:
+            self.connect()
 
     def parse_email(self, raw_email):
         """Analyse les informations importantes d'un email"""
-        msg = email.message_from_bytes(raw_email[b'BODY[]'])
+        raw = raw_email[b'BODY[]']
+        # Analyse des entetes seulement, le corps reste brut
+        msg = BytesHeaderParser().parsebytes(raw)
 
         # Traitement du sujet
-        subject = decode_header(msg["Subject"])[0][0]
-        if isinstance(subject, bytes):
-            subject = subject.decode(errors="ignore")
+        subject = _decode_subject(msg["Subject"])
 
         # Traitement corps du message
         body = ""
-        if msg.is_multipart():
-            for part in msg.walk():
+        if msg.get_content_maintype() == "multipart":
+            # Arbre MIME complet necessaire : arret a la premiere partie text/plain
+            for part in email.message_from_bytes(raw).walk():
                 if part.get_content_type() == "text/plain":
                     body = part.get_payload(decode=True).decode(errors="ignore")
                     break
@@ -68,119 +205,225 @@ class MedicalEmailAgent:
             "date": msg["Date"]
         }
 
-    def extract_requirements(self, text):
-        """Analyse sémantique avec NLP et regex"""
-        print("[INFO] Extraction des besoins")
-        doc = self.nlp(text)
+    def fetch_parsed_emails(self, email_ids):
+        """Recupere uniquement l'enveloppe et la partie text/plain des emails"""
+        structures = {}
+        for chunk in _batched(email_ids):
+            structures.update(self.conn.fetch(chunk, ["BODYSTRUCTURE", "ENVELOPE"]))
+
+        # Regroupement des emails par numéro de section text/plain
+        sections = {}
+        text_parts = {}
+        fallback_ids = []
+        for email_id in email_ids:
+            data = structures.get(email_id)
+            if data is None:
+                continue
+            part = _find_text_plain(data[b"BODYSTRUCTURE"])
+            if part is None:
+                fallback_ids.append(email_id)
+            else:
+                text_parts[email_id] = part
+                sections.setdefault(part[0], []).append(email_id)
+
+        parsed_emails = {}
+        for section, ids in sections.items():
+            key = f"BODY[{section}]".encode()
+            for chunk in _batched(ids):
+                # BODY.PEEK ne modifie pas le flag Seen
+                # Entetes From/Date bruts : meme format que parse_email
+                response = self.conn.fetch(chunk, [f"BODY.PEEK[{section}]", "BODY.PEEK[HEADER.FIELDS (FROM DATE)]"])
+                for email_id, data in response.items():
+                    _, encoding, charset = text_parts[email_id]
+                    envelope = structures[email_id][b"ENVELOPE"]
+                    headers = BytesHeaderParser().parsebytes(next(
+                        (value for name, value in data.items() if name.startswith(b"BODY[HEADER.FIELDS")), b""
+                    ))
+                    parsed_emails[email_id] = {
+                        "subject": _decode_subject(envelope.subject),
+                        "body": _decode_part(data.get(key) or b"", encoding, charset),
+                        "from": headers["From"],
+                        "date": headers["Date"]
+                    }
+
+        # Pas de partie text/plain : analyse du message complet
+        for chunk in _batched(fallback_ids):
+            for email_id, raw_email in self.conn.fetch(chunk, ["BODY.PEEK[]"]).items():
+                parsed_emails[email_id] = self.parse_email(raw_email)
 
+        # Conservation de l'ordre de la recherche IMAP
+        return {email_id: parsed_emails[email_id] for email_id in email_ids if email_id in parsed_emails}
+
+    @staticmethod
+    def _build_text(parsed_email: Dict) -> str:
+        """Texte analysé : sujet + corps du message"""
+        return f"{parsed_email['subject']}\n{parsed_email['body']}"
+
+    def extract_requirements(self, text, doc=None, dates=None):
+        """Analyse sémantique avec NLP et regex (doc et dates regex deja calculés optionnels)"""
+        logger.debug("Extraction des besoins")
+        if doc is None:
+            doc = self.nlp(text)
+        lower_text = text.lower()
+
+        # Dictionnaires utilisés comme ensembles ordonnés (dédoublonnage sans perte d'ordre)
         requirements = {
-            "profession": [],
-            "shifts": [],
-            "locations": [],
-            "dates": [],
+            "profession": {},
+            "shifts": {},
+            "locations": {},
+            "dates": {},
             "shift_duration": "",
             "urgence": False
         }
 
+        # Detection des mots-clés en un seul parcours des jetons
+        for i, token in enumerate(doc):
+            profession = PROFESSION_VOCAB.get(token.lower_)
+            if profession:
+                requirements["profession"][profession] = None
+
+            elif token.lower_ == "quart" and i + 2 < len(doc):
+                # Fenetre de 3 jetons : "quart de jour/soir/nuit"
+                shift = _SHIFT_AC.get(f"quart {doc[i + 1].lower_} {doc[i + 2].lower_}", None)
+                if shift:
+                    requirements["shifts"][shift] = None
+
         # Detection NLP avec filtrage des erreurs
         for ent in doc.ents:
-            if ent.label_ in ["GPE", "LOC"] and ent.text.lower() not in self.location_blacklist:
-                requirements["locations"].append(ent.text)
+            ent_lower = ent.text.lower()
+            if ent.label_ in ["GPE", "LOC"] and ent_lower not in PROFESSION_VOCAB \
+                    and not _LOCATION_BLACKLIST_AC.get(ent_lower, False):
+                requirements["locations"][ent.text] = None
 
             elif ent.label_ == "DATE":
                 self._parse_date(ent.text, requirements)
 
-            elif ent.label_ == "MEDICAL_PROFESSION":
-                requirements["profession"].append(ent.text.upper())
-
-            elif ent.label_ == "SHIFT_TIME":
-                requirements["shifts"].append(ent.text.lower())
-
-            elif ent.label_ == "URGENCY":
-                requirements["urgence"] = True
-
         # Detection des dates avec regex en fallback
-        date_matches = re.findall(r"\b(\d{2}/\d{2}/\d{4})\b", text)
-        for date in date_matches:
-            if date not in requirements["dates"]:
-                requirements["dates"].append(date)
+        if dates is None:
+            dates = _DATE_RE.findall(text)
+        requirements["dates"].update(dict.fromkeys(dates))
 
-        # Detection de l'urgence contextuelle
-        urgency_keywords = {"urgent", "urgence", "immédiat", "asap", "rapidement"}
-        if any(word in text.lower() for word in urgency_keywords):
-            requirements["urgence"] = True
+        # Detection de l'urgence contextuelle (recherche de sous-chaines : "urgent" couvre "urgente")
+        requirements["urgence"] = next(_URGENCY_AC.iter(lower_text), None) is not None
 
         # Detection de la durée du shift
         requirements["shift_duration"] = self._calculate_shift_duration(text)
         
         # Nettoyage des résultats (suppression des doublons)
-        requirements["profession"] = list(set(requirements["profession"]))
-        requirements["shifts"] = list(set(requirements["shifts"]))
-        requirements["locations"] = list(set(requirements["locations"]))
+        for key in ("profession", "shifts", "locations", "dates"):
+            requirements[key] = list(requirements[key])
 
-        print(f"[INFO] Resumé des besoins extraits : {requirements}")
+        logger.debug("Resumé des besoins extraits : %s", requirements)
         return requirements
 
     def _parse_date(self, text: str, requirements: Dict):
         """Analyse des dates"""
+        text = text.strip()
+        # Format jj/mm/aaaa : pas besoin de dateutil
+        if _DATE_RE.fullmatch(text):
+            requirements["dates"][text] = None
+            return
+        # Aucun chiffre : dateutil ne trouverait pas de date
+        if not any(c.isdigit() for c in text):
+            return
+
         try:
             date = parser.parse(text, dayfirst=True, fuzzy=True)
             if 2020 < date.year < 2030:
-                requirements["dates"].append(date.strftime("%d/%m/%Y"))
+                requirements["dates"][date.strftime("%d/%m/%Y")] = None
         except:
             pass
 
     def _calculate_shift_duration(self, text: str) -> str:
         """Calcul intelligent de la durée du shift"""
-        time_match = re.search(
-            r"(\d{1,2}h\d{0,2})\s*(?:-|à|au)\s*(\d{1,2}h\d{0,2})", 
-            text, 
-            re.IGNORECASE
-        )
+        time_match = _SHIFT_RE.search(text)
         
         if time_match:
-            try:
-                start = datetime.strptime(time_match.group(1).replace("h", ":"), "%H:%M")
-                end = datetime.strptime(time_match.group(2).replace("h", ":"), "%H:%M")
-
-                if end < start:  # Gestion des shifts nocturnes
-                    end += timedelta(days=1)
-                
-                duration = end - start
-                return f"{duration.seconds // 3600}h"
-            except Exception as e:
-                print(f"[WARN] Erreur de calcul de durée corrigée: {e}")
-        
+            start_h, start_m, end_h, end_m = (int(group or 0) for group in time_match.groups())
+            if max(start_h, end_h) > 23 or max(start_m, end_m) > 59:
+                logger.warning("Horaire invalide ignoré: %s", time_match.group(0))
+                return ""
+
+            start = start_h * 60 + start_m
+            end = end_h * 60 + end_m
+            if end <= start:  # Gestion des shifts nocturnes
+                end += 24 * 60
+
+            return f"{(end - start) // 60}h"
+
         return ""
 
+    def _ensure_processed_folder(self):
+        """Creation du dossier "Processed" si absent (verifié a la connexion)"""
+        if not self._has_processed:
+            self.conn.create_folder("Processed")
+            self._has_processed = True
+
+    def mark_all_as_processed(self, email_ids):
+        """Deplacer un lot d'emails dans 'Processed' en une seule commande MOVE"""
+        if not email_ids:
+            return
+        try:
+            self._ensure_processed_folder()
+        except Exception as e:
+            # Sans dossier, un repli email par email echouerait de la meme facon
+            logger.error("Impossible de créer le dossier 'Processed' : %s", e)
+            return
+
+        try:
+            self.conn.move(email_ids, "Processed")
+            logger.info("%d emails deplacés vers 'Processed'", len(email_ids))
+        except Exception as e:
+            # Repli email par email pour isoler un identifiant invalide
+            logger.warning("Echec du déplacement groupé, repli individuel : %s", e)
+            for email_id in email_ids:
+                self.mark_as_processed(email_id)
+
     def mark_as_processed(self, email_id):
         """Deplacer l'email dans le dossier 'Processed'"""
         try:
-            # Verifier si le dossier "Processed" existe
-            folders = [folder[-1] for folder in self.conn.list_folders()]
-            if "Processed" not in folders:
-                self.conn.create_folder("Processed")
-            
+            self._ensure_processed_folder()
+
             # Deplacer l'email
             self.conn.move([email_id], "Processed")
-            print(f"[SUCCESS] Email {email_id} deplacé vers 'Processed'")
+            logger.debug("Email %s deplacé vers 'Processed'", email_id)
         except Exception as e:
-            print(f"[ERROR] Erreur lors du déplacement de l'email {email_id} : {e}")
+            logger.error("Erreur lors du déplacement de l'email %s : %s", email_id, e)
 
     def process_emails(self):
         """Récupere et analyse les emails non lus"""
-        self.connect()
+        self._ensure_connection()
+        if self.conn is None:
+            return []
         try:
             emails = self.conn.search(["UNSEEN"])
-            print(f"[INFO] {len(emails)} nouveaux emails non lus trouvés")
+            logger.info("%d nouveaux emails non lus trouvés", len(emails))
+
+            parsed_emails = self.fetch_parsed_emails(emails)
+
+            # Analyse NLP groupee de tous les emails
+            texts = [
+                (self._build_text(parsed_email), email_id)
+                for email_id, parsed_email in parsed_emails.items()
+            ]
+            docs = self.nlp.pipe(
+                texts,
+                batch_size=NLP_BATCH_SIZE,
+                n_process=_nlp_process_count(len(texts)),
+                as_tuples=True
+            )
+            batch_dates = dict(zip(
+                (email_id for _, email_id in texts),
+                _find_dates_batch([text for text, _ in texts])
+            ))
 
             results = []
-            for email_id in emails:
-                raw_email = self.conn.fetch([email_id], ["BODY[]"])[email_id]
-                parsed_email = self.parse_email(raw_email)
-                print(f"\n[INFO] Traitement de l'email de {parsed_email['from']}...")
+            processed_ids = []
+            for doc, email_id in docs:
+                parsed_email = parsed_emails[email_id]
+                logger.debug("Traitement de l'email de %s...", parsed_email["from"])
 
-                requirements = self.extract_requirements(f"{parsed_email['subject']}\n{parsed_email['body']}")
+                requirements = self.extract_requirements(doc.text, doc, batch_dates[email_id])
                 classification = requirements["profession"][0] if requirements["profession"] else "non_classe"
 
                 results.append({
@@ -192,13 +435,23 @@ class MedicalEmailAgent:
                     "processed": True
                 })
 
-                self.mark_as_processed(email_id)
+                processed_ids.append(email_id)
 
+            self.mark_all_as_processed(processed_ids)
+            self._last_used = time.monotonic()
             return results
+        except (IMAPClientError, OSError) as e:
+            # Connexion perdue : reconnexion au prochain appel
+            logger.error("Erreur IMAP lors du traitement des emails: %s", e)
+            self.conn = None
+            return []
         except Exception as e:
-            print(f"[ERROR] Erreur lors du traitement des emails: {e}")
+            logger.error("Erreur lors du traitement des emails: %s", e)
             return []
 
 if __name__ == "__main__":
+    # Niveau WARNING par defaut : les messages par email ne coutent rien
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"), format="[%(levelname)s] %(message)s")
     agent = MedicalEmailAgent()
-    agent.process_emails()
+    for result in agent.process_emails():
+        print(f"[INFO] Email {result['id']} ({result['classification']}) : {result['requirements']}")